@@ -10,9 +10,12 @@
 - 运行前清空“改名后输出目录”（如不想清空，命令行加 --no-clean-out）
 - 日志仅输出到 stdout（被 Slurm 收集到 slurm.o）；除非显式传 --log-file 才额外落盘
 - 重复处理策略通过 --duplicates 指定（必填）：True=编号去重；False=直接用 OCR 为文件名，不做去重
+- 裁剪策略 --crop-strategy：merged（默认，合并外接矩形）/ largest / per-box / clustered；日志记录裁剪面积、上传字节数与 OCR 耗时
+- 可选 --watch：常驻监听输入目录，只处理新出现且已稳定的图片；不清空输出目录，编号从已有文件续接
+- 可选 --catalog：把映射记录批量写入全局 SQLite 目录库（见 tag_catalog.py），CSV 照常输出；--dry-run 时不写目录库
 """
 
-import os, re, csv, sys, uuid, time, shutil, argparse
+import os, re, csv, sys, uuid, time, shutil, signal, argparse
 import cv2
 import base64 as _b64
 from ultralytics import YOLO
@@ -29,6 +32,16 @@ DEFAULT_ARK_BASE_URL = "https://ark.cn-beijing.volces.com/api/v3"
 DEFAULT_CLASS_NAME = "WhiteTag"
 # 可在此填默认 Ark Key；留空则需要 --ark-key 或环境变量 ARK_API_KEY
 DEFAULT_ARK_KEY = "your key"
+# 裁剪策略：merged=所有框合并为最小外接矩形（旧行为）；largest=最大单框；
+# per-box=逐框裁剪；clustered=相邻框聚成簇后逐簇裁剪
+CROP_STRATEGIES = ("merged", "largest", "per-box", "clustered")
+# per-box/clustered 时最多对几个候选裁剪调用 OCR（按置信度从高到低，拿到文本即停）
+MAX_CROP_TRIES = 3
+# largest 只在置信度不低于 最高置信度×该比例 的框里取最大者，避免大面积误检压过真标签
+LARGEST_MIN_REL_CONF = 0.5
+# 监听模式下 OCR 调用出错/改名回滚的重试退避：首次等待秒数，之后每次翻倍，不超过上限
+WATCH_RETRY_BASE = 30.0
+WATCH_RETRY_MAX_DELAY = 1800.0
 
 # ========= 小工具 =========
 def log(msg: str, file=None):
@@ -67,6 +80,23 @@ def plan_final_name(base: str, counts: dict, reserved: set, ext: str, existing:
    return cand
   idx += 1
 
+def seed_count(counts: dict, base: str, existing_stems: set) -> None:
+ """
+ 从输出目录已有文件续接某个 base 的编号（不区分扩展名）：只沿 BASE-1、BASE-2… 连续往上数。
+ 不解析任意的“-数字”后缀，避免 RIL-123.jpg 这类非本工具编号的文件把 RIL 的编号推到 124。
+ """
+ IS_WIN = os.name == "nt"
+ n = counts.get(base, 0)
+ while (f"{base}-{n+1}".lower() if IS_WIN else f"{base}-{n+1}") in existing_stems:
+  n += 1
+ counts[base] = n
+
+def tmp_original_name(name: str) -> str:
+ """__TMP__<hex>__原名 → 原名；非临时名原样返回。"""
+ if name.startswith("__TMP__"):
+  return name.split("__", 3)[-1]
+ return name
+
 def safe_batch_rename(pairs, dry_run=False, log_fn=print):
  """临时名→目标名；跨盘失败回退 shutil.move。"""
  tmps = []
@@ -89,7 +119,7 @@ def safe_batch_rename(pairs, dry_run=False, log_fn=print):
   for tmp, _ in tmps:
    if tmp.exists():
     try:
-     orig = tmp.with_name(tmp.name.split("__", 2)[-1]) if "__TMP__" in tmp.name else tmp
+     orig = tmp.with_name(tmp_original_name(tmp.name))
      tmp.rename(orig)
     except Exception:
      pass
@@ -107,8 +137,12 @@ def _ndarray_to_data_url(img_bgr, mime="image/png"):
  b64 = _b64.b64encode(buf.tobytes()).decode("utf-8")
  return f"data:{mime};base64,{b64}"
 
-def _ark_ocr(client, model: str, crop_bgr, prompt: str) -> str:
+def _ark_ocr(client, model: str, crop_bgr, prompt: str, stats=None) -> str:
+ """stats 若为 dict，则回填 payload_bytes（data URL 字节数）与 secs（OCR 调用耗时）。"""
  data_url = _ndarray_to_data_url(crop_bgr, mime="image/png")
+ t0 = time.time()
+ if stats is not None:
+  stats["payload_bytes"] = len(data_url)
  try:
   resp = client.chat.completions.create(
    model=model,
@@ -125,44 +159,233 @@ def _ark_ocr(client, model: str, crop_bgr, prompt: str) -> str:
   return lines[-1] if lines else ""
  except Exception as e:
   return f"[OCR错误]{e}"
-
-# ========= YOLO 裁剪（合并标签框最小外接矩形） =========
-def _detect_crop_legacy(yolo_model, image_bgr, target_class_name: str):
- class_names = yolo_model.names
- class_id = None
- for cid, name in class_names.items():
+ finally:
+  if stats is not None:
+   stats["secs"] = time.time() - t0
+
+def ocr_best_crop(client, model: str, crops, prompt: str, img_area: int = 0, log_fn=None):
+ """
+ 按候选顺序（_crops_from_boxes 已按置信度排好）做 OCR（最多 MAX_CROP_TRIES 个），拿到文本即停。
+ 返回 (ocr_text, 所用裁剪, 每次尝试的统计 [{rect, conf, area_frac, payload_bytes, secs}, ...])。
+ """
+ ocr_text, crop, attempts = "", crops[0][0], []
+ for k, (cand, (x1, y1, x2, y2), conf) in enumerate(crops[:MAX_CROP_TRIES], 1):
+  st = {}
+  ocr_text = _ark_ocr(client, model, cand, prompt, stats=st)
+  area_frac = (x2 - x1) * (y2 - y1) / img_area if img_area else 0.0
+  attempts.append({"rect": [x1, y1, x2, y2], "conf": round(conf, 3), "area_frac": round(area_frac, 4),
+   "payload_bytes": st.get("payload_bytes", 0), "secs": round(st.get("secs", 0), 3)})
+  if log_fn:
+   log_fn(f"  裁剪 {k}/{len(crops)}：conf {conf:.2f}，{x2-x1}x{y2-y1}（{area_frac:.1%} 整图），"
+          f"上传 {st.get('payload_bytes', 0)/1024:.0f} KB，OCR {st.get('secs', 0):.2f}s")
+  crop = cand
+  if ocr_text and not ocr_text.startswith("[OCR错误]"):
+   break
+ return ocr_text, crop, attempts
+
+# ========= YOLO 裁剪 =========
+def _class_id(yolo_model, target_class_name: str):
+ for cid, name in yolo_model.names.items():
   if str(name).lower() == str(target_class_name).lower():
-   class_id = cid; break
+   return cid
+ return None
+
+def _boxes_of_class(result, class_id):
+ """返回 [(x1, y1, x2, y2, conf), ...]，保留 YOLO 置信度供候选排序。"""
+ boxes = result.boxes.cpu().numpy() if result.boxes is not None else []
+ return [tuple(map(int, box.xyxy[0])) + (float(box.conf[0]),)
+  for box in boxes if int(box.cls[0]) == class_id]
+
+def _detect_boxes(yolo_model, image_bgr, target_class_name: str):
+ """返回目标类别的全部检测框 [(x1, y1, x2, y2, conf), ...]；类别不存在时返回 None。"""
+ class_id = _class_id(yolo_model, target_class_name)
  if class_id is None:
   return None
-
- results = yolo_model(image_bgr)
- min_x, min_y = float('inf'), float('inf')
- max_x, max_y = float('-inf'), float('-inf')
- for r in results:
-  boxes = r.boxes.cpu().numpy() if r.boxes is not None else []
-  for box in boxes:
-   cls_id = int(box.cls[0])
-   if cls_id != class_id: continue
-   x1, y1, x2, y2 = map(int, box.xyxy[0])
-   min_x = min(min_x, x1); min_y = min(min_y, y1)
-   max_x = max(max_x, x2); max_y = max(max_y, y2)
-
- if min_x == float('inf'): return None
- h, w = image_bgr.shape[:2]
- x1 = max(0, min(min_x, w-1)); y1 = max(0, min(min_y, h-1))
- x2 = max(0, min(max_x, w-1)); y2 = max(0, min(max_y, h-1))
+ out = []
+ for r in yolo_model(image_bgr):
+  out.extend(_boxes_of_class(r, class_id))
+ return out
+
+def _detect_boxes_batch(yolo_model, images_bgr, target_class_name: str):
+ """一次前向处理多张图（服务模式微批），返回与输入同序的框列表；类别不存在时返回 None。"""
+ class_id = _class_id(yolo_model, target_class_name)
+ if class_id is None:
+  return None
+ results = yolo_model(list(images_bgr))
+ return [_boxes_of_class(r, class_id) for r in results]
+
+def _merge_boxes(boxes):
+ return (min(b[0] for b in boxes), min(b[1] for b in boxes),
+  max(b[2] for b in boxes), max(b[3] for b in boxes))
+
+def _box_area(b):
+ return max(0, b[2] - b[0]) * max(0, b[3] - b[1])
+
+def _cluster_boxes(boxes, gap: int):
+ """外扩 gap 后相交的框归为同一簇（并查集），返回 [[box, ...], ...]。"""
+ parent = list(range(len(boxes)))
+ def find(i):
+  while parent[i] != i:
+   parent[i] = parent[parent[i]]; i = parent[i]
+  return i
+ for i in range(len(boxes)):
+  for j in range(i + 1, len(boxes)):
+   a, b = boxes[i], boxes[j]
+   if (a[0] - gap <= b[2] and b[0] - gap <= a[2] and
+       a[1] - gap <= b[3] and b[1] - gap <= a[3]):
+    parent[find(i)] = find(j)
+ groups = defaultdict(list)
+ for i, b in enumerate(boxes):
+  groups[find(i)].append(b)
+ return list(groups.values())
+
+def _clip_rect(rect, w, h, pad: int = 0):
+ x1, y1, x2, y2 = rect[:4]
+ x1 = max(0, min(x1 - pad, w-1)); y1 = max(0, min(y1 - pad, h-1))
+ x2 = max(0, min(x2 + pad, w-1)); y2 = max(0, min(y2 + pad, h-1))
  if x2 <= x1: x2 = min(w-1, x1+1)
  if y2 <= y1: y2 = min(h-1, y1+1)
- return image_bgr[y1:y2, x1:x2]
+ return x1, y1, x2, y2
+
+def _detect_crops(yolo_model, image_bgr, target_class_name: str,
+                  strategy: str = "merged", pad: int = 0, max_area_frac: float = 1.0):
+ """
+ 按策略返回候选裁剪 [(crop_bgr, (x1, y1, x2, y2), conf), ...]，按置信度从高到低排列（同分按面积）；
+ 无检测返回 []。簇的置信度取簇内最高值。
+ 合并后的矩形（merged/clustered）若超过 max_area_frac×整图面积，则拆回其中的单框；
+ 单框本身超限时，若还有不超限的候选则丢弃它，全部超限才保留（不因上限变成 NO_DET）。
+ """
+ boxes = _detect_boxes(yolo_model, image_bgr, target_class_name)
+ return _crops_from_boxes(image_bgr, boxes, strategy, pad, max_area_frac)
+
+def _crops_from_boxes(image_bgr, boxes, strategy: str = "merged", pad: int = 0, max_area_frac: float = 1.0):
+ if not boxes: return []
+ h, w = image_bgr.shape[:2]
+ cap = max_area_frac * w * h
+
+ if strategy == "merged":
+  groups = [boxes]
+ elif strategy == "largest":
+  best = max(b[4] for b in boxes)
+  groups = [[max((b for b in boxes if b[4] >= best * LARGEST_MIN_REL_CONF), key=_box_area)]]
+ elif strategy == "per-box":
+  groups = [[b] for b in boxes]
+ elif strategy == "clustered":
+  # 簇间距：取框短边中位数的一半，同一标签被切成多块时能重新合并
+  sides = sorted(min(b[2]-b[0], b[3]-b[1]) for b in boxes)
+  groups = _cluster_boxes(boxes, gap=max(1, sides[len(sides)//2] // 2))
+ else:
+  raise ValueError(f"未知裁剪策略：{strategy}")
+
+ cands = []
+ for g in groups:
+  r = _clip_rect(_merge_boxes(g), w, h, pad)
+  if len(g) > 1 and _box_area(r) > cap:
+   cands.extend((_clip_rect(b, w, h, pad), b[4]) for b in g)
+  else:
+   cands.append((r, max(b[4] for b in g)))
+ within = [c for c in cands if _box_area(c[0]) <= cap]
+ if within: cands = within
+ cands.sort(key=lambda c: (c[1], _box_area(c[0])), reverse=True)
+ return [(image_bgr[y1:y2, x1:x2], (x1, y1, x2, y2), conf) for (x1, y1, x2, y2), conf in cands]
+
+def check_crop_options(strategy: str, pad, max_area_frac):
+ """校验裁剪参数（命令行与服务请求共用），返回规范化后的 (strategy, pad, max_area_frac)；非法时抛 ValueError。"""
+ if strategy not in CROP_STRATEGIES:
+  raise ValueError(f"未知裁剪策略：{strategy}（可选 {'/'.join(CROP_STRATEGIES)}）")
+ try:
+  pad = int(pad)
+ except (TypeError, ValueError):
+  raise ValueError(f"crop_pad 须为整数：{pad!r}")
+ if pad < 0:
+  raise ValueError(f"crop_pad 不能为负：{pad}")
+ try:
+  max_area_frac = float(max_area_frac)
+ except (TypeError, ValueError):
+  raise ValueError(f"crop_max_area 须为数字：{max_area_frac!r}")
+ if not (0 < max_area_frac <= 1):  # NaN 也不满足
+  raise ValueError(f"crop_max_area 须在 (0, 1] 之间：{max_area_frac}")
+ return strategy, pad, max_area_frac
+
+def _detect_crop_legacy(yolo_model, image_bgr, target_class_name: str):
+ """合并标签框最小外接矩形（旧接口，等价于 strategy=merged）。"""
+ crops = _detect_crops(yolo_model, image_bgr, target_class_name, strategy="merged")
+ return crops[0][0] if crops else None
 
 # ========= 遍历 =========
-def iter_images(root: Path, recursive: bool):
+def iter_images(root: Path, recursive: bool, skip_dirs=()):
+ """skip_dirs：裁剪目录/输出目录等不参与遍历（递归或监听时避免把自己的产物当输入）。"""
+ skip = [d.resolve() for d in skip_dirs]
  it = root.rglob("*") if recursive else root.iterdir()
  for p in it:
-  if p.is_file() and p.suffix.lower() in IMG_EXTS:
+  if p.is_file() and p.suffix.lower() in IMG_EXTS and not p.name.startswith("__TMP__"):
+   if skip and any(d == p.parent.resolve() or d in p.parent.resolve().parents for d in skip):
+    continue
    yield p
 
+def recover_tmp_files(root: Path, recursive: bool, dry_run=False, log_fn=print) -> int:
+ """
+ 上次运行在改名中途被杀时会留下 __TMP__ 临时文件（iter_images 不会再遍历到它们）：
+ 原名空闲则改回原名，否则只告警；演练时只告警。返回恢复数。
+ """
+ it = root.rglob("__TMP__*") if recursive else root.glob("__TMP__*")
+ restored = 0
+ for p in it:
+  if not p.is_file(): continue
+  orig = p.with_name(tmp_original_name(p.name))
+  if dry_run or orig.exists():
+   log_fn(f"[warning] 发现残留临时文件，未自动恢复：{p}")
+   continue
+  try:
+   p.rename(orig); restored += 1
+   log_fn(f"[info] 已恢复残留临时文件：{p.name} -> {orig.name}")
+  except Exception as e:
+   log_fn(f"[warning] 恢复残留临时文件失败：{p}：{e}")
+ return restored
+
+# ========= 监听模式 =========
+def load_seen(path: Path) -> set:
+ if not path.is_file(): return set()
+ with open(path, encoding="utf-8") as f:
+  return {ln.rstrip("\n") for ln in f if ln.strip()}
+
+def mark_seen(path: Path, seen: set, keys, persist: bool = True) -> None:
+ """追加写入已处理记录（每行：相对路径\t大小\tmtime_ns）；persist=False 时只记在内存（演练用）。"""
+ keys = [k for k in keys if k not in seen]
+ if not keys: return
+ if not persist:
+  seen.update(keys); return
+ path.parent.mkdir(parents=True, exist_ok=True)
+ with open(path, "a", encoding="utf-8") as f:
+  for k in keys:
+   f.write(k + "\n")
+ seen.update(keys)
+
+def stable_new_files(paths, seen: set, pending: dict, root: Path, settle: float):
+ """
+ 去抖：文件大小与 mtime 在 settle 秒内不变才视为同步完成。
+ pending 在多次轮询间保留 {path: (签名, 首次看到该签名的时间)}；返回 [(path, 签名), ...]。
+ """
+ now = time.time()
+ ready, alive = [], set()
+ for p in paths:
+  try:
+   st = p.stat()
+  except OSError:
+   continue
+  key = f"{p.relative_to(root).as_posix()}\t{st.st_size}\t{st.st_mtime_ns}"
+  if key in seen: continue
+  alive.add(p)
+  prev = pending.get(p)
+  if prev is None or prev[0] != key:
+   pending[p] = (key, now)
+  elif now - prev[1] >= settle:
+   ready.append((p, key))
+ for p in list(pending):
+  if p not in alive or any(p == r for r, _ in ready):
+   pending.pop(p, None)
+ return sorted(ready, key=lambda t: str(t[0]).lower())
+
 # ========= 主程序 =========
 def parse_bool_choice(v: str) -> bool:
  if isinstance(v, bool): return v
@@ -188,6 +411,11 @@ def main():
   help="Ark API Key（不提供时用环境变量 ARK_API_KEY；再退回 DEFAULT_ARK_KEY）")
  parser.add_argument("--ark-model", default=DEFAULT_ARK_MODEL, help="Ark 模型版本")
  parser.add_argument("--device", default="cpu", help="设备：cpu / cuda / cuda:0 等（默认 cpu）")
+ parser.add_argument("--crop-strategy", default="merged", choices=CROP_STRATEGIES,
+  help="裁剪策略：merged=合并为一个外接矩形；largest=最大单框；per-box=逐框；clustered=相邻框成簇")
+ parser.add_argument("--crop-pad", type=int, default=0, help="裁剪框四周外扩像素")
+ parser.add_argument("--crop-max-area", type=float, default=1.0,
+  help="裁剪面积上限（占整图比例 0~1）：合并框超出则拆回单框；单框超出时若有其他不超限候选则丢弃，全部超限才保留")
 
  # 裁剪图：默认保存到 INPUT/cropped，处理完成后默认清空
  parser.add_argument("--save-crops", dest="save_crops", action="store_true", default=True,
@@ -209,10 +437,25 @@ def main():
  parser.add_argument("--recursive", action="store_true", help="递归子文件夹（默认否）")
  parser.add_argument("--dry-run", action="store_true", help="仅演练，不真正改名（默认否）")
 
+ # 监听模式：常驻进程，增量处理新同步的照片
+ parser.add_argument("--watch", action="store_true",
+  help="持续监听输入目录，只处理新出现且已稳定的图片（不清空输出目录，编号从已有文件续接）")
+ parser.add_argument("--watch-interval", type=float, default=5.0, help="监听轮询间隔（秒）")
+ parser.add_argument("--watch-settle", type=float, default=10.0, help="文件大小/mtime 保持不变多久视为同步完成（秒）")
+ parser.add_argument("--watch-state", type=Path, default=None,
+  help="已处理记录文件（默认 输入目录/.watch_seen.txt）")
+ parser.add_argument("--watch-max-retries", type=int, default=5,
+  help="OCR 调用出错/改名回滚的图片最多尝试几次（指数退避），之后记为失败不再处理")
+
  # 日志：默认不落盘，仅 stdout（便于 Slurm 收集到 slurm.o）
  parser.add_argument("--csv", type=Path, default=None, help="映射表 CSV 路径（默认写到输入目录 rename_mapping.csv）")
  parser.add_argument("--log-file", type=Path, default=None, help="可选：另存日志到文件（默认不保存）")
 
+ # 全局运行目录（可选）：所有运行汇总到同一 SQLite，CSV 照常输出
+ parser.add_argument("--catalog", type=Path, default=None,
+  help="可选：全局目录库 SQLite 路径（多个文件夹/多次运行共用，便于用 tag_catalog.py 查询）")
+ parser.add_argument("--catalog-batch", type=int, default=200, help="目录库批量写入行数")
+
  # ★ 重复处理选项（必填，无默认）
  parser.add_argument("--duplicates", required=True, type=parse_bool_choice,
   help="是否存在重复样本：True=使用编号去重(Base-1/-2/-3…)，False=不做重复检测，直接用OCR结果为文件名")
@@ -229,10 +472,19 @@ def main():
  weights: Path = args.weights
  if not weights.is_file():
   print(f"错误：YOLO 权重不存在：{weights}"); sys.exit(2)
+ try:
+  check_crop_options(args.crop_strategy, args.crop_pad, args.crop_max_area)
+ except ValueError as e:
+  print(f"错误：{e}"); sys.exit(2)
  if in_dir.resolve() == args.out_renamed.resolve():
   print("错误：改名后输出目录不能与输入目录相同。"); sys.exit(2)
  out_dir: Path = args.out_renamed; out_dir.mkdir(parents=True, exist_ok=True)
 
+ # 监听模式下绝不清空输出目录：新批次要在已有结果上续接编号
+ if args.watch and args.clean_out:
+  args.clean_out = False
+  print("[info] 监听模式：忽略 --clean-out，保留输出目录已有文件")
+
  # 运行前清空输出目录（默认真）
  if args.clean_out:
   cnt = 0
@@ -249,7 +501,7 @@ def main():
  log_fp = None
  if args.log_file:
   args.log_file.parent.mkdir(parents=True, exist_ok=True)
-  log_fp = open(args.log_file, "w", encoding="utf-8")
+  log_fp = open(args.log_file, "a" if args.watch else "w", encoding="utf-8")
 
  # Ark Key 优先级：命令行 > 环境变量 > 代码常量
  ark_key = (args.ark_key or os.getenv("ARK_API_KEY") or DEFAULT_ARK_KEY).strip()
@@ -284,114 +536,263 @@ def main():
   crops_dir.mkdir(parents=True, exist_ok=True)
   log(f"[info] 裁剪图输出：{crops_dir}", log_fp)
 
- # CSV 映射表
+ # CSV 映射表（监听模式下追加写入，避免覆盖之前批次）
  out_csv = (args.csv if args.csv else (in_dir / "rename_mapping.csv"))
  out_csv.parent.mkdir(parents=True, exist_ok=True)
- fcsv = open(out_csv, "w", newline="", encoding="utf-8")
+ csv_append = args.watch and out_csv.is_file() and out_csv.stat().st_size > 0
+ fcsv = open(out_csv, "a" if csv_append else "w", newline="", encoding="utf-8")
  writer = csv.writer(fcsv)
- writer.writerow(["src_dir","old_name","ocr_text","base_sanitized","index","final_name","status"])
+ if not csv_append:
+  writer.writerow(["src_dir","old_name","ocr_text","base_sanitized","index","final_name","status"])
+
+ # 目录库：按需惰性导入（仅标准库），与 CSV 同步记录
+ # 演练不落目录库：演练行的 final_name 并不存在于磁盘，会污染“某编号有哪些照片”的查询
+ catalog = None
+ if args.catalog and args.dry_run:
+  log("[info] 演练模式：不写入目录库", log_fp)
+ elif args.catalog:
+  try:
+   from tag_catalog import CatalogSink
+   catalog = CatalogSink(args.catalog, input_dir=in_dir.resolve(), out_dir=out_dir.resolve(),
+    batch_size=args.catalog_batch, source_path=out_csv.resolve())
+   log(f"[info] 目录库：{args.catalog}（run {catalog.run_id}）", log_fp)
+  except Exception as e:
+   log(f"[warning] 目录库不可用，仅写 CSV：{e}", log_fp)
+   catalog = None
+
+ # 目录库跨运行/跨工作目录共用，src_dir 存绝对路径；CSV 保持原样
+ abs_dirs = {}
+ def record(row):
+  writer.writerow(row)
+  if catalog:
+   try:
+    if row[0] not in abs_dirs:
+     abs_dirs[row[0]] = str(Path(row[0]).resolve())
+    catalog.add([abs_dirs[row[0]]] + row[1:])
+   except Exception as e:
+    log(f"[warning] 目录库写入失败：{e}", log_fp)
 
- planned = []
+ # 编号/占用状态跨批次保留；“已存在”缓存每批重建
  counts_by_dir = defaultdict(dict)
  reserved_by_dir = defaultdict(set)
- existing_cache = {}
 
- images = sorted(list(iter_images(in_dir, recursive=args.recursive)), key=lambda p: str(p).lower())
- total = len(images)
- if total == 0:
-  log("未发现待处理图片。", log_fp); fcsv.close(); sys.exit(0)
-
- ok = fail = 0
- t0 = time.time()
- for i, img_path in enumerate(images, 1):
-  log(f"{i}/{total} 处理：{img_path.name}", log_fp)
-  img = cv2.imread(str(img_path))
-  if img is None:
-   writer.writerow([str(img_path.parent), img_path.name, "", "", "", "", "READ_FAIL"]); fail += 1
-   log(f"[跳过] 无法读取：{img_path.name}", log_fp); continue
-
-  crop = _detect_crop_legacy(model, img, args.class_name)
-  if crop is None:
-   writer.writerow([str(img_path.parent), img_path.name, "", "", "", "", "NO_DET"]); fail += 1
-   log(f"[提示] 未检测到 {args.class_name}：{img_path.name}", log_fp); continue
-
-  if save_crops and crops_dir:
-   cp = crops_dir / f"{img_path.stem}_cropped{img_path.suffix.lower()}"
+ def run_batch(images, last_try=None):
+  """
+  返回 (ok, fail, done)。done 为真正处理完的图片：已移走的，以及确定性失败
+  （READ_FAIL / NO_DET / NAME_CONFLICT / OCR 返回空）；改名回滚的不算，下次轮询重试。
+  last_try 为 None 时 OCR 调用出错直接记 NO_TEXT；否则只有 last_try 中的图片才记，
+  其余的不写行、不计数、不算 done，留给调用方退避重试。
+  """
+  rows = []     # 本批 CSV 行，按输入顺序；改名结束后统一写出
+  planned = []  # (src, dst, OK 行在 rows 中的下标)；改名失败时原地改为 RENAME_FAIL
+  existing_cache = {}
+  existing_stems = {}
+  counts_snap = {d: dict(c) for d, c in counts_by_dir.items()}
+  ok = fail = 0
+  done = []
+  total = len(images)
+  for i, img_path in enumerate(images, 1):
+   log(f"{i}/{total} 处理：{img_path.name}", log_fp)
+   img = cv2.imread(str(img_path))
+   if img is None:
+    rows.append([str(img_path.parent), img_path.name, "", "", "", "", "READ_FAIL"]); fail += 1
+    done.append(img_path)
+    log(f"[跳过] 无法读取：{img_path.name}", log_fp); continue
+
+   crops = _detect_crops(model, img, args.class_name, strategy=args.crop_strategy,
+    pad=args.crop_pad, max_area_frac=args.crop_max_area)
+   if not crops:
+    rows.append([str(img_path.parent), img_path.name, "", "", "", "", "NO_DET"]); fail += 1
+    done.append(img_path)
+    log(f"[提示] 未检测到 {args.class_name}：{img_path.name}", log_fp); continue
+
+   ocr_text, crop, _ = ocr_best_crop(client, args.ark_model, crops, args.prompt,
+    img_area=img.shape[0] * img.shape[1], log_fn=lambda s: log(s, log_fp))
+
+   if save_crops and crops_dir:
+    cp = crops_dir / f"{img_path.stem}_cropped{img_path.suffix.lower()}"
+    try:
+     import cv2 as _cv2
+     _cv2.imwrite(str(cp), crop)
+     log(f"Saved crop: {cp.name}", log_fp)
+    except Exception as e:
+     log(f"[warning] 保存裁剪失败：{e}", log_fp)
+
+   if (not ocr_text) or ocr_text.startswith("[OCR错误]"):
+    if ocr_text.startswith("[OCR错误]") and last_try is not None and img_path not in last_try:
+     log(f"[提示] OCR 调用出错，稍后重试：{ocr_text}", log_fp); continue
+    rows.append([str(img_path.parent), img_path.name, ocr_text, "", "", "", "NO_TEXT"]); fail += 1
+    done.append(img_path)
+    log(f"[提示] OCR 无结果/错误：{ocr_text}", log_fp); continue
+
+   base = sanitize_and_upper(ocr_text)
+   ext = img_path.suffix.lower()
+   target_dir = out_dir
+
+   # 为冲突检查构建“已存在”缓存（大小写无关/有关由平台决定）
+   if target_dir not in existing_cache:
+    IS_WIN = os.name == "nt"
+    existing_cache[target_dir] = {
+     (p.name.lower() if IS_WIN else p.name)
+     for p in target_dir.iterdir() if p.is_file()
+    }
+    existing_stems[target_dir] = {Path(n).stem for n in existing_cache[target_dir]}
+
+   if args.duplicates:
+    # === 有重复：使用编号去重（只对本批实际出现的 base 从已有文件续接编号） ===
+    seed_count(counts_by_dir[target_dir], base, existing_stems[target_dir])
+    final_name = plan_final_name(base, counts_by_dir[target_dir],
+     reserved_by_dir[target_dir], ext, existing_cache[target_dir])
+    dst = target_dir / final_name
+    # 解析索引
+    try:
+     idx_val = int(Path(final_name).stem.split("-")[-1])
+    except Exception:
+     idx_val = ""
+    planned.append((img_path, dst, len(rows)))
+    rows.append([str(img_path.parent), img_path.name, ocr_text, base, idx_val, final_name, "OK"])
+    log(f"✔ {img_path.name} -> {final_name}", log_fp); ok += 1
+   else:
+    # === 无重复：直接用 OCR 结果作为文件名，不做编号/去重 ===
+    final_name = f"{base}{ext}"
+    key = (final_name.lower() if os.name == "nt" else final_name)
+    if (key in existing_cache[target_dir]) or (key in reserved_by_dir[target_dir]):
+     rows.append([str(img_path.parent), img_path.name, ocr_text, base, "", final_name, "NAME_CONFLICT"])
+     log(f"[冲突] 目标已存在，跳过：{final_name}", log_fp); fail += 1
+     done.append(img_path)
+     continue
+    reserved_by_dir[target_dir].add(key)
+    dst = target_dir / final_name
+    planned.append((img_path, dst, len(rows)))
+    rows.append([str(img_path.parent), img_path.name, ocr_text, base, "", final_name, "OK"])
+    log(f"✔ {img_path.name} -> {final_name}", log_fp); ok += 1
+
+  # 执行批量改名/移动
+  rename_failed = False
+  try:
+   safe_batch_rename([(s, d) for s, d, _ in planned], dry_run=args.dry_run, log_fn=lambda s: log(s, log_fp))
+  except Exception as e:
+   log(f"[目录级错误] 改名中断：{e}", log_fp)
+   rename_failed = True
+  if rename_failed:
+   # 回滚后源文件回到输入目录：记为 RENAME_FAIL、释放占用的目标名，留待下次重试；已落到目标的照常记 OK
+   IS_WIN = os.name == "nt"
+   for d, c in counts_snap.items():
+    counts_by_dir[d] = c
+   for src, dst, j in planned:
+    if (not src.exists()) and dst.exists():
+     done.append(src)
+    else:
+     rows[j][-1] = "RENAME_FAIL"; ok -= 1; fail += 1
+     reserved_by_dir[dst.parent].discard(dst.name.lower() if IS_WIN else dst.name)
+  else:
+   done.extend(src for src, _, _ in planned)
+  for row in rows:
+   record(row)
+  fcsv.flush()
+  if catalog:
    try:
-    import cv2 as _cv2
-    _cv2.imwrite(str(cp), crop)
-    log(f"Saved crop: {cp.name}", log_fp)
+    catalog.flush()
    except Exception as e:
-    log(f"[warning] 保存裁剪失败：{e}", log_fp)
+    log(f"[warning] 目录库写入失败：{e}", log_fp)
+  return ok, fail, done
 
-  # OCR
-  ocr_text = _ark_ocr(client, args.ark_model, crop, args.prompt)
-  if (not ocr_text) or ocr_text.startswith("[OCR错误]"):
-   writer.writerow([str(img_path.parent), img_path.name, ocr_text, "", "", "", "NO_TEXT"]); fail += 1
-   log(f"[提示] OCR 无结果/错误：{ocr_text}", log_fp); continue
+ def clean_crops():
+  if save_crops and crops_dir and args.clean_crops_after and crops_dir.exists():
+   removed = 0
+   for p in crops_dir.glob("*"):
+    try:
+     if p.is_file():
+      p.unlink()
+     else:
+      shutil.rmtree(p)
+     removed += 1
+    except Exception:
+     pass
+   log(f"[info] 已清空裁剪目录 {crops_dir}（删除 {removed} 项）", log_fp)
 
-  base = sanitize_and_upper(ocr_text)
-  ext = img_path.suffix.lower()
-  target_dir = out_dir
+ skip_dirs = [d for d in (crops_dir, out_dir) if d]
+ recover_tmp_files(in_dir, args.recursive, dry_run=args.dry_run, log_fn=lambda s: log(s, log_fp))
+ ok = fail = 0
+ t0 = time.time()
 
-  # 为冲突检查构建“已存在”缓存（大小写无关/有关由平台决定）
-  if target_dir not in existing_cache:
-   IS_WIN = os.name == "nt"
-   existing_cache[target_dir] = {
-    (p.name.lower() if IS_WIN else p.name)
-    for p in target_dir.iterdir() if p.is_file()
-   }
-
-  if args.duplicates:
-   # === 有重复：使用编号去重 ===
-   final_name = plan_final_name(base, counts_by_dir[target_dir],
-    reserved_by_dir[target_dir], ext, existing_cache[target_dir])
-   dst = target_dir / final_name
-   planned.append((img_path, dst))
-   # 解析索引
+ if args.watch:
+  # === 监听模式：模型与 OCR 客户端常驻，轮询新文件，稳定后成批处理 ===
+  seen_path = args.watch_state if args.watch_state else (in_dir / ".watch_seen.txt")
+  seen = load_seen(seen_path)
+  log(f"[watch] 监听 {in_dir}（轮询 {args.watch_interval}s，稳定 {args.watch_settle}s），"
+      f"已处理记录 {len(seen)} 条：{seen_path}", log_fp)
+  if args.dry_run:
+   log("[watch] 演练模式：已处理记录只保存在内存，不写入文件", log_fp)
+  # Ctrl+C / SIGTERM 只置停止标志，当前批次（含 CSV/目录库写入与批量改名）跑完后再退出，
+  # 避免留下已记 OK 却未改名的行或 __TMP__ 临时文件
+  stopping = []
+  def _stop(signum, frame):
+   stopping.append(signum)  # 处理器里不打日志：可能打断正在进行的 print
+  for sig in (signal.SIGINT, signal.SIGTERM):
    try:
-    idx_val = int(Path(final_name).stem.split("-")[-1])
+    signal.signal(sig, _stop)
    except Exception:
-    idx_val = ""
-   writer.writerow([str(img_path.parent), img_path.name, ocr_text, base, idx_val, final_name, "OK"])
-   log(f"✔ {img_path.name} -> {final_name}", log_fp); ok += 1
-  else:
-   # === 无重复：直接用 OCR 结果作为文件名，不做编号/去重 ===
-   final_name = f"{base}{ext}"
-   key = (final_name.lower() if os.name == "nt" else final_name)
-   if (key in existing_cache[target_dir]) or (key in reserved_by_dir[target_dir]):
-    writer.writerow([str(img_path.parent), img_path.name, ocr_text, base, "", final_name, "NAME_CONFLICT"])
-    log(f"[冲突] 目标已存在，跳过：{final_name}", log_fp); fail += 1
-    continue
-   reserved_by_dir[target_dir].add(key)
-   dst = target_dir / final_name
-   planned.append((img_path, dst))
-   writer.writerow([str(img_path.parent), img_path.name, ocr_text, base, "", final_name, "OK"])
-   log(f"✔ {img_path.name} -> {final_name}", log_fp); ok += 1
-
- # 执行批量改名/移动
- try:
-  safe_batch_rename(planned, dry_run=args.dry_run, log_fn=lambda s: log(s, log_fp))
- except Exception as e:
-  log(f"[目录级错误] 改名中断：{e}", log_fp)
+    pass
+  pending = {}
+  retries = {}  # {path: (签名, 已尝试次数, 下次可尝试时间)}，只在内存，重启后重新计数
+  max_tries = max(1, args.watch_max_retries)
+  while not stopping:
+   cands = iter_images(in_dir, recursive=args.recursive, skip_dirs=skip_dirs)
+   now = time.time()
+   ready = []
+   for p, k in stable_new_files(cands, seen, pending, in_dir, args.watch_settle):
+    r = retries.get(p)
+    if r and r[0] != k:
+     retries.pop(p); r = None  # 文件已变化，重新计数
+    if r is None or now >= r[2]:
+     ready.append((p, k))
+   if ready:
+    log(f"[watch] 新批次：{len(ready)} 张", log_fp)
+    last_try = {p for p, _ in ready if retries.get(p, (None, 0, 0))[1] + 1 >= max_tries}
+    bok, bfail, bdone = run_batch([p for p, _ in ready], last_try=last_try)
+    ok += bok; fail += bfail
+    # 只记录真正处理完的；OCR 出错/改名回滚的按指数退避重试，达到次数上限后放弃
+    done_set = set(bdone)
+    finished = []
+    for p, k in ready:
+     if p in done_set:
+      retries.pop(p, None); finished.append(k); continue
+     tries = retries.get(p, (None, 0, 0))[1] + 1
+     if tries >= max_tries:
+      retries.pop(p, None); finished.append(k)
+      log(f"[watch] 已尝试 {tries} 次仍失败，放弃：{p.name}", log_fp)
+     else:
+      delay = min(WATCH_RETRY_BASE * 2 ** (tries - 1), WATCH_RETRY_MAX_DELAY)
+      retries[p] = (k, tries, time.time() + delay)
+      log(f"[watch] 第 {tries} 次未完成，{delay:.0f}s 后重试：{p.name}", log_fp)
+    mark_seen(seen_path, seen, finished, persist=not args.dry_run)
+    clean_crops()
+    log(f"[watch] 批次完成：成功 {bok}，失败 {bfail}；累计成功 {ok}，失败 {fail}", log_fp)
+   deadline = time.time() + args.watch_interval
+   while not stopping and time.time() < deadline:
+    time.sleep(min(0.2, args.watch_interval))
+  log("[watch] 收到停止信号，已在批次间退出监听。", log_fp)
+ else:
+  images = sorted(list(iter_images(in_dir, recursive=args.recursive, skip_dirs=skip_dirs)),
+   key=lambda p: str(p).lower())
+  if not images:
+   log("未发现待处理图片。", log_fp); fcsv.close()
+   if catalog: catalog.close(ok=0, fail=0)
+   sys.exit(0)
+  ok, fail, _ = run_batch(images)
 
  fcsv.close()
+ if catalog:
+  try:
+   catalog.close(ok=ok, fail=fail)
+  except Exception as e:
+   log(f"[warning] 目录库提交失败：{e}", log_fp)
  log(f"\n完成：成功 {ok}，失败 {fail}，耗时 {time.time()-t0:.1f}s", log_fp)
  log(f"映射表：{out_csv}", log_fp)
 
  # 处理完成后按默认清空裁剪目录
- if save_crops and crops_dir and args.clean_crops_after and crops_dir.exists():
-  removed = 0
-  for p in crops_dir.glob("*"):
-   try:
-    if p.is_file():
-     p.unlink()
-    else:
-     shutil.rmtree(p)
-    removed += 1
-   except Exception:
-    pass
-  log(f"[info] 已清空裁剪目录 {crops_dir}（删除 {removed} 项）", log_fp)
+ clean_crops()
 
  if log_fp:
   log_fp.close()
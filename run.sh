@@ -37,6 +37,7 @@ for IN in "$ROOT"/*/; do
   # 如需递归：在上面命令末尾加 --recursive
   # 如需演练：加 --dry-run
   # 如需同时落盘日志：加 --log-file rename_run_$(date +%Y%m%d_%H%M%S).log
+  # 如需汇总到全局目录库：加 --catalog "$ROOT/catalog.db"（之后用 tag_catalog.py 查询）
 
   ret=$?
   echo "====== DONE: $base (ret=$ret) ======"
@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+全局运行目录（SQLite）：汇总所有批次的改名映射，便于跨文件夹查询/导出
+依赖：仅标准库（sqlite3）
+说明：
+- WAL 模式 + busy_timeout，多文件夹并发写入同一库文件也不会互相阻塞太久
+- 每次运行生成 run_id，记录行先缓冲、按批 executemany 提交
+- 列与 rename_mapping.csv 保持一致，CSV 输出不受影响
+- runs 记录对应 CSV 的绝对路径（导入时另记 mtime），重复导入同一 CSV 会跳过或拒绝（--force 强制）
+用法示例：
+  python tag_catalog.py -d catalog.db runs
+  python tag_catalog.py -d catalog.db query --base RIL123
+  python tag_catalog.py -d catalog.db export --status NO_DET -o no_det.csv
+"""
+
+import os, csv, sys, time, uuid, sqlite3, argparse
+from pathlib import Path
+
+CSV_COLUMNS = ["src_dir", "old_name", "ocr_text", "base_sanitized", "index", "final_name", "status"]
+DEFAULT_BATCH_SIZE = 200
+BUSY_TIMEOUT_MS = 30000
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+ run_id     TEXT PRIMARY KEY,
+ started_at TEXT NOT NULL,
+ ended_at   TEXT,
+ host       TEXT,
+ input_dir  TEXT,
+ out_dir    TEXT,
+ ok         INTEGER,
+ fail       INTEGER,
+ source_path  TEXT,
+ source_mtime INTEGER
+);
+CREATE TABLE IF NOT EXISTS mappings (
+ id             INTEGER PRIMARY KEY AUTOINCREMENT,
+ run_id         TEXT NOT NULL REFERENCES runs(run_id),
+ src_dir        TEXT,
+ old_name       TEXT,
+ ocr_text       TEXT,
+ base_sanitized TEXT,
+ idx            INTEGER,
+ final_name     TEXT,
+ status         TEXT,
+ created_at     TEXT
+);
+CREATE INDEX IF NOT EXISTS ix_mappings_base   ON mappings(base_sanitized);
+CREATE INDEX IF NOT EXISTS ix_mappings_status ON mappings(status);
+CREATE INDEX IF NOT EXISTS ix_mappings_run    ON mappings(run_id);
+"""
+# 旧库缺少的 runs 列：打开时补齐
+_RUNS_ADDED_COLUMNS = {"source_path": "TEXT", "source_mtime": "INTEGER"}
+
+def _now() -> str:
+ return time.strftime("%Y-%m-%d %H:%M:%S")
+
+def _connect(db_path: Path):
+ db_path = Path(db_path)
+ db_path.parent.mkdir(parents=True, exist_ok=True)
+ conn = sqlite3.connect(str(db_path), timeout=BUSY_TIMEOUT_MS / 1000)
+ conn.execute(f"PRAGMA busy_timeout={BUSY_TIMEOUT_MS}")
+ conn.execute("PRAGMA journal_mode=WAL")
+ conn.execute("PRAGMA synchronous=NORMAL")
+ conn.executescript(_SCHEMA)
+ have = {r[1] for r in conn.execute("PRAGMA table_info(runs)")}
+ for col, typ in _RUNS_ADDED_COLUMNS.items():
+  if col not in have:
+   try:
+    conn.execute(f"ALTER TABLE runs ADD COLUMN {col} {typ}")
+   except sqlite3.OperationalError:
+    pass  # 并发打开时另一进程已补上
+ conn.execute("CREATE INDEX IF NOT EXISTS ix_runs_source ON runs(source_path)")
+ return conn
+
+# ========= 写入端 =========
+class CatalogSink:
+ """一次运行对应一个 sink：add() 缓冲，满 batch_size 或 close() 时批量写入。"""
+
+ def __init__(self, db_path: Path, input_dir=None, out_dir=None, batch_size: int = DEFAULT_BATCH_SIZE,
+              source_path=None, source_mtime=None):
+  self.db_path = Path(db_path)
+  self.batch_size = max(1, int(batch_size))
+  self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+  self._buf = []
+  self._conn = _connect(self.db_path)
+  with self._conn:
+   self._conn.execute(
+    "INSERT INTO runs(run_id, started_at, host, input_dir, out_dir, source_path, source_mtime)"
+    " VALUES (?,?,?,?,?,?,?)",
+    (self.run_id, _now(), os.uname().nodename if hasattr(os, "uname") else os.getenv("COMPUTERNAME", ""),
+     str(input_dir) if input_dir else None, str(out_dir) if out_dir else None,
+     str(source_path) if source_path else None, source_mtime))
+
+ def add(self, row):
+  """row 与 CSV 行同序：src_dir, old_name, ocr_text, base_sanitized, index, final_name, status"""
+  src_dir, old_name, ocr_text, base, idx, final_name, status = row
+  self._buf.append((self.run_id, src_dir, old_name, ocr_text, base,
+   idx if idx != "" else None, final_name, status, _now()))
+  if len(self._buf) >= self.batch_size:
+   self.flush()
+
+ def flush(self):
+  if not self._buf: return
+  with self._conn:
+   self._conn.executemany(
+    "INSERT INTO mappings(run_id, src_dir, old_name, ocr_text, base_sanitized, idx, final_name, status, created_at)"
+    " VALUES (?,?,?,?,?,?,?,?,?)", self._buf)
+  self._buf = []
+
+ def close(self, ok=None, fail=None):
+  try:
+   self.flush()
+   with self._conn:
+    self._conn.execute("UPDATE runs SET ended_at=?, ok=?, fail=? WHERE run_id=?",
+     (_now(), ok, fail, self.run_id))
+  finally:
+   self._conn.close()
+
+# ========= 查询端 =========
+def _like_escape(s: str) -> str:
+ """转义 LIKE 元字符：base_sanitized 允许 _，不转义会被当成单字符通配。"""
+ return s.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+def query_rows(db_path: Path, base=None, status=None, run_id=None, src_dir=None, like=False, limit=None):
+ where, params = [], []
+ if base:
+  if like:
+   where.append("base_sanitized LIKE ? ESCAPE '\\'"); params.append(_like_escape(base.upper()).replace("*", "%"))
+  else:
+   where.append("base_sanitized = ?"); params.append(base.upper())
+ if status:
+  where.append("status = ?"); params.append(status.upper())
+ if run_id:
+  where.append("run_id = ?"); params.append(run_id)
+ if src_dir:
+  where.append("src_dir LIKE ? ESCAPE '\\'"); params.append(f"%{_like_escape(src_dir)}%")
+ sql = "SELECT run_id, src_dir, old_name, ocr_text, base_sanitized, idx, final_name, status FROM mappings"
+ if where: sql += " WHERE " + " AND ".join(where)
+ sql += " ORDER BY id"
+ if limit: sql += f" LIMIT {int(limit)}"
+ conn = _connect(db_path)
+ try:
+  return conn.execute(sql, params).fetchall()
+ finally:
+  conn.close()
+
+def list_runs(db_path: Path):
+ conn = _connect(db_path)
+ try:
+  return conn.execute(
+   "SELECT run_id, started_at, ended_at, input_dir, out_dir, ok, fail FROM runs ORDER BY started_at").fetchall()
+ finally:
+  conn.close()
+
+def import_csv(db_path: Path, csv_path: Path, force: bool = False):
+ """
+ 把历史 rename_mapping.csv 导入为一次独立运行，返回 run_id；未导入时返回 None。
+ 同一路径、同一 mtime 已导入过则跳过；该路径已有其他运行记录（较早的导入，或带 --catalog 的运行
+ 本身写的这份 CSV）则拒绝，避免重复行。force=True 时照常导入。
+ """
+ csv_path = Path(csv_path).resolve()
+ mtime = csv_path.stat().st_mtime_ns
+ if not force:
+  conn = _connect(db_path)
+  try:
+   prev = conn.execute("SELECT run_id, source_mtime FROM runs WHERE source_path = ? ORDER BY started_at",
+    (str(csv_path),)).fetchall()
+  finally:
+   conn.close()
+  if any(m == mtime for _, m in prev):
+   print(f"[跳过] 已导入过（未变化）：{csv_path}"); return None
+  if prev:
+   print(f"[跳过] 目录库中已有该 CSV 的记录（run {', '.join(r for r, _ in prev)}），"
+         f"再导入会产生重复行；确需导入请加 --force：{csv_path}")
+   return None
+ sink = CatalogSink(db_path, input_dir=csv_path.parent, source_path=csv_path, source_mtime=mtime)
+ n = 0
+ with open(csv_path, newline="", encoding="utf-8") as f:
+  for rec in csv.DictReader(f):
+   sink.add([rec.get(c, "") for c in CSV_COLUMNS]); n += 1
+ sink.close(ok=None, fail=None)
+ print(f"[info] 已导入 {n} 行：{csv_path} -> run {sink.run_id}")
+ return sink.run_id
+
+# ========= 命令行 =========
+def main():
+ parser = argparse.ArgumentParser(
+  description="Tag catalog query/export",
+  formatter_class=argparse.ArgumentDefaultsHelpFormatter
+ )
+ parser.add_argument("-d", "--db", required=True, type=Path, help="目录库 SQLite 文件")
+ sub = parser.add_subparsers(dest="cmd", required=True)
+
+ sub.add_parser("runs", help="列出所有运行")
+
+ def _filters(p):
+  p.add_argument("--base", default=None, help="按 base_sanitized 过滤（如 RIL123；配合 --like 可用 * 通配）")
+  p.add_argument("--like", action="store_true", help="--base 按通配匹配")
+  p.add_argument("--status", default=None, help="按状态过滤（OK / NO_DET / NO_TEXT / READ_FAIL / NAME_CONFLICT / RENAME_FAIL）")
+  p.add_argument("--run", dest="run_id", default=None, help="按 run_id 过滤")
+  p.add_argument("--src-dir", default=None, help="按源目录子串过滤")
+  p.add_argument("--limit", type=int, default=None, help="最多返回行数")
+
+ q = sub.add_parser("query", help="查询映射记录（制表符分隔输出到 stdout）")
+ _filters(q)
+ e = sub.add_parser("export", help="导出映射记录为 CSV")
+ _filters(e)
+ e.add_argument("-o", "--out", required=True, type=Path, help="导出 CSV 路径")
+ imp = sub.add_parser("import-csv", help="导入已有的 rename_mapping.csv")
+ imp.add_argument("csv_files", nargs="+", type=Path, help="CSV 文件")
+ imp.add_argument("--force", action="store_true", help="即使该 CSV 已在目录库中也再次导入")
+
+ args = parser.parse_args()
+
+ if args.cmd != "import-csv" and not args.db.is_file():
+  print(f"错误：目录库不存在：{args.db}"); sys.exit(2)
+
+ if args.cmd == "runs":
+  for r in list_runs(args.db):
+   print("\t".join("" if v is None else str(v) for v in r))
+ elif args.cmd == "import-csv":
+  for p in args.csv_files:
+   if not p.is_file():
+    print(f"[跳过] CSV 不存在：{p}"); continue
+   import_csv(args.db, p, force=args.force)
+ else:
+  rows = query_rows(args.db, base=args.base, status=args.status, run_id=args.run_id,
+   src_dir=args.src_dir, like=args.like, limit=args.limit)
+  header = ["run_id"] + CSV_COLUMNS
+  if args.cmd == "query":
+   print("\t".join(header))
+   for r in rows:
+    print("\t".join("" if v is None else str(v) for v in r))
+   print(f"[info] 共 {len(rows)} 行", file=sys.stderr)
+  else:
+   args.out.parent.mkdir(parents=True, exist_ok=True)
+   with open(args.out, "w", newline="", encoding="utf-8") as f:
+    w = csv.writer(f)
+    w.writerow(header)
+    w.writerows(["" if v is None else v for v in r] for r in rows)
+   print(f"[info] 已导出 {len(rows)} 行：{args.out}")
+
+if __name__ == "__main__":
+ main()
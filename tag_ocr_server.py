@@ -0,0 +1,376 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+本地服务版：常驻加载 YOLO 与 Ark 客户端，通过 HTTP 提供“照片 → 标签文本”
+依赖：同 AI_Tags_OCR.py（ultralytics, opencv-python, volcenginesdkarkruntime），HTTP 部分仅用标准库
+说明：
+- 并发请求在短时间窗口内合并成一批做 YOLO 检测（微批），OCR 走共享线程池
+- 结果按 图像内容哈希 + 提示词/模型/裁剪参数 缓存（LRU），重复请求不再调用 Ark
+- 默认只监听 127.0.0.1
+接口：
+  POST /ocr    JSON {"path": "...", "prompt": "..."} 或 {"image_b64": "..."}；
+               也可直接以图片字节作为请求体，参数放在查询串（?prompt=...&crop_strategy=...）；
+               未声明 JSON 但以 { 开头的请求体也按 JSON 解析，既非 JSON 又解不出图片的返回 415
+  GET  /stats  队列深度、缓存命中、各阶段延迟（p50/p95）
+  GET  /health
+示例：
+  python tag_ocr_server.py -w best.pt --prompt "只输出标签上的编号" --device cuda:0
+  curl -s localhost:8765/ocr -H "Content-Type: application/json" -d '{"path": "/data/IMG_0001.jpg"}'
+  curl -s localhost:8765/ocr --data-binary @IMG_0001.jpg -H "Content-Type: image/jpeg"
+"""
+
+import os, sys, json, time, queue, hashlib, argparse, threading
+import base64 as _b64
+from pathlib import Path
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import cv2
+import numpy as np
+from ultralytics import YOLO
+
+from AI_Tags_OCR import (
+ DEFAULT_ARK_MODEL, DEFAULT_ARK_KEY, DEFAULT_CLASS_NAME, CROP_STRATEGIES,
+ log, sanitize_and_upper, _normalize_device_str, _ark_client,
+ _detect_boxes_batch, _crops_from_boxes, ocr_best_crop, check_crop_options,
+)
+
+DEFAULT_HOST = "127.0.0.1"
+DEFAULT_PORT = 8765
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+# ========= 统计 =========
+class LatencyStats:
+ """保留最近 window 次耗时，给出 count/avg/p50/p95/max（毫秒）。"""
+
+ def __init__(self, window: int = 1000):
+  self._buf = deque(maxlen=window)
+  self._count = 0
+  self._lock = threading.Lock()
+
+ def add(self, secs: float):
+  with self._lock:
+   self._buf.append(secs); self._count += 1
+
+ def summary(self) -> dict:
+  with self._lock:
+   vals = sorted(self._buf); n = self._count
+  if not vals:
+   return {"count": n}
+  pick = lambda q: vals[min(len(vals) - 1, int(q * len(vals)))] * 1000
+  return {"count": n, "avg_ms": round(sum(vals) / len(vals) * 1000, 1),
+   "p50_ms": round(pick(0.50), 1), "p95_ms": round(pick(0.95), 1), "max_ms": round(vals[-1] * 1000, 1)}
+
+class ResultCache:
+ """线程安全 LRU。"""
+
+ def __init__(self, size: int):
+  self.size = size
+  self._d = OrderedDict()
+  self._lock = threading.Lock()
+  self.hits = self.misses = 0
+
+ def get(self, key):
+  with self._lock:
+   if key in self._d:
+    self._d.move_to_end(key); self.hits += 1
+    return self._d[key]
+   self.misses += 1
+   return None
+
+ def put(self, key, value):
+  if self.size <= 0: return
+  with self._lock:
+   self._d[key] = value; self._d.move_to_end(key)
+   while len(self._d) > self.size:
+    self._d.popitem(last=False)
+
+ def __len__(self):
+  return len(self._d)
+
+# ========= 检测微批 =========
+class DetectBatcher:
+ """
+ 后台线程：取到第一张图后最多再等 window_s，凑满 max_batch 或超时即一次前向。
+ YOLO 只在这个线程里调用，避免多线程同时推理。
+ """
+
+ def __init__(self, yolo_model, class_name: str, window_s: float, max_batch: int, log_fn=print):
+  self.model = yolo_model
+  self.class_name = class_name
+  self.window_s = window_s
+  self.max_batch = max(1, max_batch)
+  self.log_fn = log_fn
+  self._q = queue.Queue()
+  self.batches = self.images = self.max_seen = 0
+  self.infer = LatencyStats()
+  self._t = threading.Thread(target=self._loop, name="detect-batcher", daemon=True)
+  self._t.start()
+
+ def submit(self, image_bgr) -> Future:
+  fut = Future()
+  self._q.put((image_bgr, fut))
+  return fut
+
+ def depth(self) -> int:
+  return self._q.qsize()
+
+ def _loop(self):
+  while True:
+   batch = [self._q.get()]
+   deadline = time.time() + self.window_s
+   while len(batch) < self.max_batch:
+    remain = deadline - time.time()
+    if remain <= 0: break
+    try:
+     batch.append(self._q.get(timeout=remain))
+    except queue.Empty:
+     break
+   t0 = time.time()
+   try:
+    boxes = _detect_boxes_batch(self.model, [img for img, _ in batch], self.class_name)
+    if boxes is None:
+     boxes = [None] * len(batch)
+    for (_, fut), b in zip(batch, boxes):
+     fut.set_result(b)
+   except Exception as e:
+    self.log_fn(f"[错误] 批量检测失败（{len(batch)} 张）：{e}")
+    for _, fut in batch:
+     if not fut.done(): fut.set_exception(e)
+   self.infer.add(time.time() - t0)
+   self.batches += 1; self.images += len(batch)
+   self.max_seen = max(self.max_seen, len(batch))
+
+# ========= 服务 =========
+class TagOcrService:
+ def __init__(self, yolo_model, client, args):
+  self.client = client
+  self.args = args
+  self.batcher = DetectBatcher(yolo_model, args.class_name, args.batch_window_ms / 1000,
+   args.max_batch, log_fn=log)
+  self.ocr_pool = ThreadPoolExecutor(max_workers=max(1, args.ocr_workers), thread_name_prefix="ocr")
+  self.cache = ResultCache(args.cache_size)
+  self.lat = {k: LatencyStats() for k in ("detect_wait", "ocr", "total")}
+  self._inflight = 0
+  self._lock = threading.Lock()
+  self.started = time.time()
+
+ def process(self, data: bytes, prompt: str = None, crop_strategy: str = None,
+             crop_pad: int = None, crop_max_area: float = None) -> dict:
+  a = self.args
+  prompt = (prompt or a.prompt).strip()
+  # 与命令行同一套校验；非法值抛 ValueError，由 HTTP 层转成 400，不会进入裁剪或缓存键
+  strategy, pad, max_area = check_crop_options(
+   crop_strategy or a.crop_strategy,
+   a.crop_pad if crop_pad is None else crop_pad,
+   a.crop_max_area if crop_max_area is None else crop_max_area)
+
+  t0 = time.time()
+  key = hashlib.sha1(data).hexdigest() + "|" + "|".join(map(str, (prompt, a.ark_model, strategy, pad, max_area)))
+  hit = self.cache.get(key)
+  if hit is not None:
+   return dict(hit, cached=True)
+
+  with self._lock: self._inflight += 1
+  try:
+   res = self._process_uncached(data, prompt, strategy, pad, max_area)
+  finally:
+   with self._lock: self._inflight -= 1
+  res["timings"]["total_ms"] = round((time.time() - t0) * 1000, 1)
+  self.lat["total"].add(time.time() - t0)
+  # OCR 出错不缓存，便于重试
+  if res["status"] != "NO_TEXT" or not res["ocr_text"].startswith("[OCR错误]"):
+   self.cache.put(key, res)
+  return dict(res, cached=False)
+
+ def _process_uncached(self, data, prompt, strategy, pad, max_area) -> dict:
+  res = {"status": "", "ocr_text": "", "base_sanitized": "", "boxes": [], "attempts": [], "timings": {}}
+  img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), cv2.IMREAD_COLOR)
+  if img is None:
+   res["status"] = "READ_FAIL"; return res
+
+  t = time.time()
+  boxes = self.batcher.submit(img).result()
+  self.lat["detect_wait"].add(time.time() - t)
+  res["timings"]["detect_ms"] = round((time.time() - t) * 1000, 1)
+  crops = _crops_from_boxes(img, boxes, strategy, pad, max_area)
+  res["boxes"] = [list(r) + [round(conf, 3)] for _, r, conf in crops]
+  if not crops:
+   res["status"] = "NO_DET"; return res
+
+  t = time.time()
+  ocr_text, _, attempts = self.ocr_pool.submit(
+   ocr_best_crop, self.client, self.args.ark_model, crops, prompt, img.shape[0] * img.shape[1]).result()
+  self.lat["ocr"].add(time.time() - t)
+  res["timings"]["ocr_ms"] = round((time.time() - t) * 1000, 1)
+  res["attempts"] = attempts
+  res["ocr_text"] = ocr_text
+  if (not ocr_text) or ocr_text.startswith("[OCR错误]"):
+   res["status"] = "NO_TEXT"; return res
+  res["base_sanitized"] = sanitize_and_upper(ocr_text)
+  res["status"] = "OK"
+  return res
+
+ def stats(self) -> dict:
+  b = self.batcher
+  return {
+   "uptime_s": round(time.time() - self.started, 1),
+   "queue": {"detect_depth": self.batcher.depth(), "ocr_pending": self.ocr_pool._work_queue.qsize(),
+    "inflight": self._inflight},
+   "detect_batches": {"count": b.batches, "images": b.images, "max_size": b.max_seen,
+    "avg_size": round(b.images / b.batches, 2) if b.batches else None, "infer": b.infer.summary()},
+   "cache": {"size": len(self.cache), "capacity": self.cache.size, "hits": self.cache.hits, "misses": self.cache.misses},
+   "latency": {k: v.summary() for k, v in self.lat.items()},
+  }
+
+# ========= HTTP =========
+def _make_handler(service: TagOcrService):
+ class Handler(BaseHTTPRequestHandler):
+  protocol_version = "HTTP/1.1"
+
+  def log_message(self, fmt, *args):
+   pass  # 由 service 统一记录，避免每个请求刷屏
+
+  def _send(self, code: int, obj: dict):
+   body = json.dumps(obj, ensure_ascii=False).encode("utf-8")
+   self.send_response(code)
+   self.send_header("Content-Type", "application/json; charset=utf-8")
+   self.send_header("Content-Length", str(len(body)))
+   if self.close_connection:
+    self.send_header("Connection", "close")
+   self.end_headers()
+   self.wfile.write(body)
+
+  def do_GET(self):
+   path = urlparse(self.path).path
+   if path == "/health":
+    self._send(200, {"ok": True})
+   elif path == "/stats":
+    self._send(200, service.stats())
+   else:
+    self._send(404, {"error": f"未知路径：{path}"})
+
+  def do_POST(self):
+   # 以下几处提前返回时请求体未读：必须关闭连接，否则 keep-alive 下残留字节会被当成下一个请求解析
+   url = urlparse(self.path)
+   if url.path != "/ocr":
+    self.close_connection = True
+    self._send(404, {"error": f"未知路径：{url.path}"}); return
+   try:
+    n = int(self.headers.get("Content-Length") or 0)
+   except ValueError:
+    n = -1
+   if n <= 0 or n > MAX_BODY_BYTES:
+    self.close_connection = True
+    self._send(413 if n > MAX_BODY_BYTES else 400, {"error": "请求体为空、过大或 Content-Length 无效"}); return
+   raw = self.rfile.read(n)
+   params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+   # curl -d 默认发 application/x-www-form-urlencoded：以 { 开头的请求体按 JSON 处理，不当图片字节
+   is_json = ((self.headers.get("Content-Type") or "").startswith("application/json")
+              or raw.lstrip()[:1] == b"{")
+   try:
+    if is_json:
+     body = json.loads(raw.decode("utf-8"))
+     if not isinstance(body, dict):
+      self._send(400, {"error": "JSON 请求体必须是对象"}); return
+     params.update(body)
+     bad = [k for k in ("path", "image_b64", "prompt", "crop_strategy")
+            if params.get(k) is not None and not isinstance(params[k], str)]
+     if bad:
+      self._send(400, {"error": f"字段必须是字符串：{', '.join(bad)}"}); return
+     if params.get("path"):
+      p = Path(params["path"])
+      if not p.is_file():
+       self._send(404, {"error": f"文件不存在：{p}"}); return
+      data = p.read_bytes()
+     elif params.get("image_b64"):
+      data = _b64.b64decode(params["image_b64"], validate=True)  # 非法字符抛 binascii.Error（ValueError）→ 400
+     else:
+      self._send(400, {"error": "需要 path 或 image_b64"}); return
+    else:
+     data = raw
+    res = service.process(data, prompt=params.get("prompt"), crop_strategy=params.get("crop_strategy"),
+     crop_pad=params.get("crop_pad"), crop_max_area=params.get("crop_max_area"))
+   except ValueError as e:
+    self._send(400, {"error": str(e)}); return
+   except Exception as e:
+    log(f"[错误] 请求处理失败：{e}")
+    self._send(500, {"error": str(e)}); return
+   if not is_json and res["status"] == "READ_FAIL":
+    self._send(415, {"error": "请求体既不是 JSON 也不是可解码的图片"}); return
+   if params.get("path"):
+    res["path"] = params["path"]
+   log(f"{res['status']} {res.get('path', f'<{len(data)} bytes>')} -> {res['ocr_text']!r}"
+       f"{'（缓存）' if res['cached'] else ''}")
+   self._send(200, res)
+
+ return Handler
+
+def main():
+ parser = argparse.ArgumentParser(
+  description="YOLO_OCR local service",
+  formatter_class=argparse.ArgumentDefaultsHelpFormatter
+ )
+ parser.add_argument("-w", "--weights", required=True, type=Path, help="YOLO 权重 .pt")
+ parser.add_argument("--prompt", required=True, help="默认 OCR 提示词（请求中可用 prompt 覆盖）")
+ parser.add_argument("--host", default=DEFAULT_HOST, help="监听地址")
+ parser.add_argument("--port", type=int, default=DEFAULT_PORT, help="监听端口")
+
+ parser.add_argument("--class-name", default=DEFAULT_CLASS_NAME, help="YOLO 类别名")
+ parser.add_argument("--ark-key", default=None,
+  help="Ark API Key（不提供时用环境变量 ARK_API_KEY；再退回 DEFAULT_ARK_KEY）")
+ parser.add_argument("--ark-model", default=DEFAULT_ARK_MODEL, help="Ark 模型版本")
+ parser.add_argument("--device", default="cpu", help="设备：cpu / cuda / cuda:0 等（默认 cpu）")
+ parser.add_argument("--crop-strategy", default="merged", choices=CROP_STRATEGIES, help="默认裁剪策略")
+ parser.add_argument("--crop-pad", type=int, default=0, help="默认裁剪外扩像素")
+ parser.add_argument("--crop-max-area", type=float, default=1.0, help="默认裁剪面积上限（占整图比例，规则同 AI_Tags_OCR.py）")
+
+ # 微批/并发/缓存
+ parser.add_argument("--batch-window-ms", type=float, default=20.0, help="检测微批等待窗口（毫秒）")
+ parser.add_argument("--max-batch", type=int, default=8, help="单批最多图片数")
+ parser.add_argument("--ocr-workers", type=int, default=4, help="OCR 并发线程数（共享 Ark 客户端）")
+ parser.add_argument("--cache-size", type=int, default=1024, help="结果缓存条数（0 关闭）")
+ args = parser.parse_args()
+
+ if not str(args.prompt).strip():
+  print("错误：--prompt 不能为空。"); sys.exit(2)
+ if not args.weights.is_file():
+  print(f"错误：YOLO 权重不存在：{args.weights}"); sys.exit(2)
+ try:
+  check_crop_options(args.crop_strategy, args.crop_pad, args.crop_max_area)
+ except ValueError as e:
+  print(f"错误：{e}"); sys.exit(2)
+ ark_key = (args.ark_key or os.getenv("ARK_API_KEY") or DEFAULT_ARK_KEY).strip()
+ if not ark_key:
+  print("错误：未提供 Ark API Key（--ark-key 或 ARK_API_KEY，或在脚本 DEFAULT_ARK_KEY 中填写）")
+  sys.exit(2)
+
+ device = _normalize_device_str(args.device)
+ client = _ark_client(ark_key)
+ log("加载 YOLO 权重中...")
+ model = YOLO(str(args.weights))
+ if device and device != "cpu":
+  try:
+   model.to(device); log(f"使用设备：{device}")
+  except Exception as e:
+   log(f"[warning] 切换设备失败，使用默认设备：{e}")
+ else:
+  log("使用设备：cpu")
+
+ service = TagOcrService(model, client, args)
+ server = ThreadingHTTPServer((args.host, args.port), _make_handler(service))
+ server.daemon_threads = True
+ log(f"[info] 服务已启动：http://{args.host}:{args.port}（POST /ocr，GET /stats）")
+ try:
+  server.serve_forever()
+ except KeyboardInterrupt:
+  pass
+ finally:
+  server.server_close()
+  service.ocr_pool.shutdown(wait=False)
+  log("[info] 服务已停止。")
+
+if __name__ == "__main__":
+ main()